@@ -14,8 +14,10 @@ todos los componentes con animaciones sutiles para una experiencia premium.
 import streamlit as st
 from firebase_utils import FirebaseUtils
 from gemini_utils import GeminiUtils
-from utils import generar_pdf, calcular_puntaje_findrisc, obtener_interpretacion_riesgo, generar_grafico_riesgo
+from storage_utils import BlobStore
+from utils import generar_pdf, calcular_puntaje_findrisc, obtener_interpretacion_riesgo, generar_grafico_riesgo, generar_grafico_historial
 from datetime import datetime
+import uuid
 
 # --- CONFIGURACIÓN DE PÁGINA ---
 st.set_page_config(
@@ -182,6 +184,16 @@ firebase, gemini = initialize_services()
 if not firebase or not gemini:
     st.stop()
 
+# --- ALMACÉN COMPARTIDO PARA DATOS GRANDES DE SESIÓN ---
+# Las sesiones guardan solo claves; el análisis de IA y el chat viven aquí.
+@st.cache_resource
+def initialize_blob_store():
+    return BlobStore(max_bytes=64 * 1024 * 1024, spill_to_disk=True)
+
+blob_store = initialize_blob_store()
+if 'session_id' not in st.session_state: st.session_state['session_id'] = uuid.uuid4().hex
+blob_store.touch(st.session_state['session_id'])
+
 # --- Componentes de la Interfaz ---
 
 def app_header(page_options, current_page):
@@ -194,6 +206,9 @@ def app_header(page_options, current_page):
         if st.button("🚪 Cerrar Sesión", use_container_width=True):
             st.session_state['logged_in'] = False
             st.session_state['user_uid'] = None
+            blob_store.delete_session(st.session_state['session_id'])
+            st.session_state.pop('last_submission_key', None)
+            st.session_state.pop('chat_history_key', None)
             st.rerun()
         st.markdown('</div>', unsafe_allow_html=True)
     st.divider()
@@ -230,8 +245,9 @@ def new_test_page():
         submit_button = st.form_submit_button("Calcular Riesgo y Generar Reporte", use_container_width=True)
     st.markdown('</div>', unsafe_allow_html=True)
     
-    if "last_submission" in st.session_state and st.session_state.last_submission:
-        display_results(st.session_state.last_submission)
+    ultimo = blob_store.get(st.session_state.get("last_submission_key"))
+    if ultimo:
+        display_results(ultimo)
 
     if submit_button:
         if altura > 0:
@@ -244,7 +260,7 @@ def new_test_page():
                 datos_usuario["analisis_ia"] = analisis_ia
             
             firebase.guardar_datos_test(st.session_state['user_uid'], datos_usuario)
-            st.session_state.last_submission = datos_usuario
+            st.session_state.last_submission_key = blob_store.put(st.session_state['session_id'], "last_submission", datos_usuario)
             st.rerun()
         else:
             st.error("La altura no puede ser cero.")
@@ -260,14 +276,17 @@ def display_results(datos):
         st.metric("Puntaje FINDRISC", f"{datos['puntaje']} puntos")
         st.metric("Nivel de Riesgo", datos['nivel_riesgo'])
         st.info(f"**Estimación a 10 años:** {datos['estimacion']}")
-        pdf_bytes = generar_pdf(datos)
-        st.download_button(label="📥 Descargar Reporte en PDF", data=pdf_bytes, file_name=f"Reporte_Diabetes_{datetime.now().strftime('%Y%m%d')}.pdf", mime="application/pdf", use_container_width=True)
+        # El PDF se genera solo cuando se pide: st.download_button guarda su propia copia de los bytes.
+        if st.button("📄 Preparar Reporte en PDF", use_container_width=True):
+            st.download_button(label="📥 Descargar Reporte en PDF", data=generar_pdf(datos), file_name=f"Reporte_Diabetes_{datetime.now().strftime('%Y%m%d')}.pdf", mime="application/pdf", use_container_width=True)
     
     st.markdown('<h3 style="font-weight: 600; margin-top: 2rem;">🧠 Análisis y Recomendaciones por IA</h3>', unsafe_allow_html=True)
     st.markdown(f'<div style="background-color: var(--bg-color); padding: 1.5rem; border-radius: 10px;">{datos["analisis_ia"]}</div>', unsafe_allow_html=True)
     st.markdown('</div>', unsafe_allow_html=True)
 
 
+TESTS_POR_PAGINA = 10
+
 def history_page():
     st.markdown('<p class="page-header">Historial de Tests</p>', unsafe_allow_html=True)
     st.markdown('<div class="card">', unsafe_allow_html=True)
@@ -275,7 +294,14 @@ def history_page():
     historial = firebase.cargar_datos_test(st.session_state['user_uid'])
     if historial:
         st.success(f"Se encontraron {len(historial)} registros en tu historial.")
-        for test in historial:
+        st.plotly_chart(generar_grafico_historial(historial), use_container_width=True)
+        # La gráfica cubre todo el historial; el detalle se pagina para no crear un expander por cada test.
+        total_paginas = (len(historial) - 1) // TESTS_POR_PAGINA + 1
+        pagina = 1
+        if total_paginas > 1:
+            pagina = st.number_input(f"Página del detalle (1-{total_paginas}, más recientes primero)", 1, total_paginas, 1)
+        inicio = (pagina - 1) * TESTS_POR_PAGINA
+        for test in historial[inicio:inicio + TESTS_POR_PAGINA]:
             fecha_test = datetime.fromisoformat(test['fecha']).strftime('%d-%m-%Y %H:%M')
             with st.expander(f"Test del {fecha_test} - Puntaje: {test.get('puntaje', 'N/A')} ({test.get('nivel_riesgo', 'N/A')})"):
                 st.write(f"**IMC:** {test.get('imc', 0):.2f}, **Cintura:** {test.get('cintura', 'N/A')} cm")
@@ -291,16 +317,19 @@ def chatbot_page():
     st.markdown('<p class="page-header">Asistente de IA</p>', unsafe_allow_html=True)
     st.markdown('<div class="card">', unsafe_allow_html=True)
     # ... (código del chatbot sin cambios)
-    if "chat_history" not in st.session_state: st.session_state.chat_history = []
-    for msg in st.session_state.chat_history:
+    session_id = st.session_state['session_id']
+    chat_history = blob_store.get(st.session_state.get("chat_history_key"), [])
+    for msg in chat_history:
         with st.chat_message(msg["role"]): st.markdown(msg["content"])
     if prompt := st.chat_input("Escribe tu pregunta aquí..."):
-        st.session_state.chat_history.append({"role": "user", "content": prompt})
+        chat_history.append({"role": "user", "content": prompt})
+        st.session_state.chat_history_key = blob_store.put(session_id, "chat_history", chat_history)
         with st.chat_message("user"): st.markdown(prompt)
         with st.spinner("Pensando..."):
             full_prompt = f"Como un asistente de salud experto en diabetes, responde la siguiente pregunta de forma clara y concisa en español: '{prompt}'"
             respuesta = gemini.llamar_gemini_directo(full_prompt)
-            st.session_state.chat_history.append({"role": "assistant", "content": respuesta})
+            chat_history.append({"role": "assistant", "content": respuesta})
+            st.session_state.chat_history_key = blob_store.put(session_id, "chat_history", chat_history)
         with st.chat_message("assistant"): st.markdown(respuesta)
     st.markdown('</div>', unsafe_allow_html=True)
 
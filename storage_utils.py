@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import stat
+import time
+import uuid
+import atexit
+import shutil
+import pickle
+import tempfile
+import threading
+import zlib
+import logging
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: se usa solo la comprobación por PID
+    fcntl = None
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+PREFIJO_SPILL = "saludia_blobs_"
+ARCHIVO_BLOQUEO = ".lock"
+_NOMBRE_BLOB = re.compile(r"^[0-9a-f]{32}$")
+
+class BlobStore:
+    """
+    Almacén compartido por todo el proceso para datos grandes de sesión
+    (análisis de IA e historial del chat).
+    - La memoria está acotada por `max_bytes` y se libera con política LRU.
+    - Los blobs mayores a `compress_min_bytes` se guardan comprimidos con zlib.
+    - Con `spill_to_disk`, lo desalojado se escribe a disco (acotado por
+      `max_disk_bytes`) en lugar de perderse, y se recupera al volver a pedirlo.
+      Por defecto se usa un directorio privado (0700) creado con `mkdtemp` y
+      borrado al salir; `spill_dir` permite fijarlo, siempre que pertenezca a
+      este usuario y no tenga permisos para grupo u otros.
+    - Las sesiones sin actividad durante `session_ttl` segundos se liberan, para
+      que las abandonadas no desplacen a disco los datos de las activas.
+    Las lecturas y escrituras de disco se hacen fuera del lock, de modo que los
+    hilos de otras sesiones no esperan por E/S; mientras un blob desalojado se
+    escribe sigue disponible en memoria.
+    Las sesiones solo guardan en `st.session_state` las claves de sus blobs.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, compress_min_bytes=1024, spill_to_disk=False, spill_dir=None,
+                 max_disk_bytes=512 * 1024 * 1024, session_ttl=2 * 60 * 60, log_every=100):
+        self.max_bytes = max_bytes
+        self.compress_min_bytes = compress_min_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.session_ttl = session_ttl
+        self.log_every = log_every
+        self._memoria = OrderedDict()  # clave -> (datos, comprimido, session_id)
+        self._en_escritura = {}        # clave -> (datos, comprimido, session_id) desalojado, aún sin escribir a disco
+        self._disco = OrderedDict()    # clave -> (ruta, tamaño, comprimido, session_id)
+        self._ultimo_acceso = {}       # session_id -> time.monotonic() del último uso
+        self._ultima_limpieza = time.monotonic()
+        self._bytes_memoria = 0
+        self._bytes_disco = 0
+        self._desalojos = 0
+        self._descartes_disco = 0
+        self._sesiones_expiradas = 0
+        self._escrituras = 0
+        self._lock = threading.Lock()
+        self._fd_bloqueo = None
+        self.spill_dir = None
+        if spill_dir:
+            self.spill_dir = self._preparar_directorio(spill_dir)
+        elif spill_to_disk:
+            self._limpiar_directorios_huerfanos()
+            self.spill_dir = tempfile.mkdtemp(prefix=f"{PREFIJO_SPILL}{os.getpid()}_")
+            self._fd_bloqueo = self._bloquear_directorio(self.spill_dir)
+            atexit.register(shutil.rmtree, self.spill_dir, True)
+
+    # --- API pública ---
+    def put(self, session_id, nombre, valor):
+        """Guarda `valor` bajo la sesión dada y devuelve la clave para recuperarlo."""
+        clave = f"{session_id}:{nombre}"
+        datos = pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL)
+        comprimido = len(datos) >= self.compress_min_bytes
+        if comprimido:
+            datos = zlib.compress(datos, 6)
+        with self._lock:
+            borrar = self._limpiar_sesiones_expiradas()
+            borrar += self._eliminar(clave)
+            self._memoria[clave] = (datos, comprimido, session_id)
+            self._bytes_memoria += len(datos)
+            self._ultimo_acceso[session_id] = time.monotonic()
+            desalojados = self._ajustar_memoria()
+            self._escrituras += 1
+            registrar = self.log_every and self._escrituras % self.log_every == 0
+        self._desbordar(desalojados, borrar)
+        if registrar:
+            self.log_stats()
+        return clave
+
+    def get(self, clave, default=None):
+        """Recupera el valor de una clave; los datos en disco se vuelven a cargar en memoria."""
+        if not clave:
+            return default
+        with self._lock:
+            entrada = self._memoria.get(clave)
+            if entrada is not None:
+                self._memoria.move_to_end(clave)
+            else:
+                entrada = self._en_escritura.get(clave)
+            entrada_disco = self._disco.get(clave) if entrada is None else None
+            if entrada is None and entrada_disco is None:
+                return default
+            sesion = (entrada or entrada_disco)[-1]
+            self._ultimo_acceso[sesion] = time.monotonic()
+        if entrada is None:
+            entrada = self._recuperar_de_disco(clave, entrada_disco)
+            if entrada is None:
+                return default
+        datos, comprimido, _ = entrada
+        if comprimido:
+            datos = zlib.decompress(datos)
+        return pickle.loads(datos)
+
+    def touch(self, session_id):
+        """Marca la sesión como activa aunque no lea ni escriba blobs en esta ejecución."""
+        with self._lock:
+            self._ultimo_acceso[session_id] = time.monotonic()
+
+    def delete(self, clave):
+        if not clave:
+            return
+        with self._lock:
+            borrar = self._eliminar(clave)
+        self._desbordar([], borrar)
+
+    def delete_session(self, session_id):
+        """Libera todos los blobs de una sesión (p. ej. al cerrar sesión)."""
+        with self._lock:
+            borrar = self._eliminar_sesion(session_id)
+        self._desbordar([], borrar)
+
+    def stats(self):
+        """Resumen de uso de memoria total y por sesión, para monitoreo."""
+        with self._lock:
+            sesiones = {}
+            for datos, _, session_id in list(self._memoria.values()) + list(self._en_escritura.values()):
+                sesiones.setdefault(session_id, {"memoria": 0, "disco": 0})["memoria"] += len(datos)
+            for _, tamano, _, session_id in self._disco.values():
+                sesiones.setdefault(session_id, {"memoria": 0, "disco": 0})["disco"] += tamano
+            return {
+                "bytes_memoria": self._bytes_memoria,
+                "bytes_disco": self._bytes_disco,
+                "max_bytes": self.max_bytes,
+                "blobs_memoria": len(self._memoria),
+                "blobs_disco": len(self._disco),
+                "desalojos": self._desalojos,
+                "descartes_disco": self._descartes_disco,
+                "sesiones_expiradas": self._sesiones_expiradas,
+                "sesiones": sesiones,
+            }
+
+    def log_stats(self):
+        """Envía al log el uso total y el de la sesión que más ocupa."""
+        uso = self.stats()
+        sesiones = uso["sesiones"]
+        mayor = max(sesiones.items(), key=lambda s: s[1]["memoria"] + s[1]["disco"], default=(None, {"memoria": 0, "disco": 0}))
+        logger.info(f"BlobStore: {uso['bytes_memoria']}/{uso['max_bytes']} bytes en memoria ({uso['blobs_memoria']} blobs), "
+                    f"{uso['bytes_disco']} bytes en disco ({uso['blobs_disco']} blobs), {len(sesiones)} sesiones, "
+                    f"mayor sesión {mayor[1]['memoria'] + mayor[1]['disco']} bytes, "
+                    f"{uso['desalojos']} desalojos, {uso['descartes_disco']} descartes de disco, "
+                    f"{uso['sesiones_expiradas']} sesiones expiradas.")
+
+    # --- Preparación del directorio de desborde ---
+    def _preparar_directorio(self, ruta):
+        """Valida un directorio configurado (propio y privado) y borra los blobs de procesos anteriores."""
+        os.makedirs(ruta, mode=0o700, exist_ok=True)
+        info = os.lstat(ruta)
+        if not stat.S_ISDIR(info.st_mode):
+            raise ValueError(f"El directorio de desborde '{ruta}' no es un directorio.")
+        if hasattr(os, "getuid") and info.st_uid != os.getuid():
+            raise ValueError(f"El directorio de desborde '{ruta}' no pertenece a este usuario.")
+        if info.st_mode & 0o077:
+            raise ValueError(f"El directorio de desborde '{ruta}' tiene permisos abiertos a grupo u otros.")
+        self._fd_bloqueo = self._bloquear_directorio(ruta)
+        if self._fd_bloqueo is None and fcntl is not None:
+            raise ValueError(f"El directorio de desborde '{ruta}' ya está en uso por otro almacén.")
+        for nombre in os.listdir(ruta):
+            if _NOMBRE_BLOB.match(nombre):
+                BlobStore._borrar_archivo(os.path.join(ruta, nombre))
+        return ruta
+
+    @staticmethod
+    def _bloquear_directorio(ruta):
+        """Toma un flock exclusivo sobre el directorio mientras el almacén exista; None si ya está tomado."""
+        if fcntl is None:
+            return None
+        fd = os.open(os.path.join(ruta, ARCHIVO_BLOQUEO), os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+    @staticmethod
+    def _limpiar_directorios_huerfanos():
+        """
+        Borra directorios de desborde propios dejados por procesos que ya no existen (p. ej. tras un OOM).
+        Un directorio está vivo mientras su almacén mantenga el flock, aunque sea de este mismo proceso
+        (p. ej. tras limpiar `st.cache_resource`) o el PID se haya reutilizado tras un reinicio.
+        """
+        base = tempfile.gettempdir()
+        try:
+            nombres = os.listdir(base)
+        except OSError:
+            return
+        for nombre in nombres:
+            if not nombre.startswith(PREFIJO_SPILL):
+                continue
+            pid = nombre[len(PREFIJO_SPILL):].split("_", 1)[0]
+            ruta = os.path.join(base, nombre)
+            try:
+                info = os.lstat(ruta)
+            except OSError:
+                continue
+            if not pid.isdigit() or not stat.S_ISDIR(info.st_mode):
+                continue
+            if hasattr(os, "getuid") and info.st_uid != os.getuid():
+                continue
+            if os.path.exists(os.path.join(ruta, ARCHIVO_BLOQUEO)) and fcntl is not None:
+                fd = BlobStore._bloquear_directorio(ruta)
+                if fd is None:
+                    continue
+                os.close(fd)
+            elif int(pid) == os.getpid() or BlobStore._proceso_vivo(int(pid)):
+                continue
+            logger.info(f"BlobStore: eliminando directorio de desborde huérfano '{ruta}'.")
+            shutil.rmtree(ruta, ignore_errors=True)
+
+    @staticmethod
+    def _proceso_vivo(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except (PermissionError, OSError):
+            return True
+        return True
+
+    # --- Internos (requieren tener el lock); devuelven rutas a borrar fuera del lock ---
+    def _eliminar(self, clave):
+        entrada = self._memoria.pop(clave, None)
+        if entrada is not None:
+            self._bytes_memoria -= len(entrada[0])
+        self._en_escritura.pop(clave, None)
+        entrada_disco = self._disco.pop(clave, None)
+        if entrada_disco is not None:
+            self._bytes_disco -= entrada_disco[1]
+            return [entrada_disco[0]]
+        return []
+
+    def _eliminar_sesion(self, session_id):
+        prefijo = f"{session_id}:"
+        borrar = []
+        for clave in [c for c in list(self._memoria) + list(self._en_escritura) + list(self._disco) if c.startswith(prefijo)]:
+            borrar += self._eliminar(clave)
+        self._ultimo_acceso.pop(session_id, None)
+        return borrar
+
+    def _limpiar_sesiones_expiradas(self):
+        """Libera, como mucho cada `session_ttl / 10` segundos, las sesiones sin actividad reciente."""
+        ahora = time.monotonic()
+        if not self.session_ttl or ahora - self._ultima_limpieza < self.session_ttl / 10:
+            return []
+        self._ultima_limpieza = ahora
+        borrar = []
+        for session_id in [s for s, t in self._ultimo_acceso.items() if ahora - t > self.session_ttl]:
+            borrar += self._eliminar_sesion(session_id)
+            self._sesiones_expiradas += 1
+            logger.info(f"BlobStore: liberados los blobs de la sesión inactiva '{session_id}'.")
+        return borrar
+
+    def _ajustar_memoria(self):
+        """Desaloja por LRU; lo desalojado queda en `_en_escritura` hasta que `_desbordar` lo escriba."""
+        desalojados = []
+        while self._bytes_memoria > self.max_bytes and len(self._memoria) > 1:
+            clave, entrada = self._memoria.popitem(last=False)
+            self._bytes_memoria -= len(entrada[0])
+            self._desalojos += 1
+            if self._desalojos % 100 == 0:
+                logger.info(f"BlobStore: {self._desalojos} desalojos, {self._bytes_memoria} bytes en memoria, {self._bytes_disco} bytes en disco.")
+            if self.spill_dir:
+                self._en_escritura[clave] = entrada
+                desalojados.append((clave, entrada))
+            else:
+                self._descartes_disco += 1
+                logger.warning(f"BlobStore: blob '{clave}' descartado al desalojarlo (sin directorio de desborde).")
+        return desalojados
+
+    def _ajustar_disco(self):
+        borrar = []
+        while self._bytes_disco > self.max_disk_bytes and self._disco:
+            clave, (ruta, tamano, _, _) = self._disco.popitem(last=False)
+            self._bytes_disco -= tamano
+            borrar.append(ruta)
+            self._descartes_disco += 1
+            logger.warning(f"BlobStore: blob '{clave}' descartado del disco por superar {self.max_disk_bytes} bytes "
+                           f"({self._descartes_disco} descartes en total).")
+        return borrar
+
+    # --- E/S de disco (sin el lock) ---
+    def _desbordar(self, desalojados, borrar=()):
+        """Borra archivos obsoletos y escribe a disco lo desalojado, tomando el lock solo para registrarlo."""
+        for ruta in borrar:
+            self._borrar_archivo(ruta)
+        if not desalojados:
+            return
+        escritos = []
+        for clave, entrada in desalojados:
+            ruta = os.path.join(self.spill_dir, uuid.uuid4().hex)
+            try:
+                fd = os.open(ruta, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_NOFOLLOW", 0), 0o600)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(entrada[0])
+            except OSError as e:
+                logger.warning(f"BlobStore: no se pudo escribir '{clave}' a disco, se descarta: {e}")
+                self._borrar_archivo(ruta)
+                ruta = None
+            escritos.append((clave, entrada, ruta))
+        sobrantes = []
+        with self._lock:
+            for clave, entrada, ruta in escritos:
+                if self._en_escritura.get(clave) is not entrada:
+                    # Se borró, reemplazó o volvió a leer mientras se escribía.
+                    if ruta:
+                        sobrantes.append(ruta)
+                    continue
+                del self._en_escritura[clave]
+                if ruta is None:
+                    self._descartes_disco += 1
+                    continue
+                datos, comprimido, session_id = entrada
+                self._disco[clave] = (ruta, len(datos), comprimido, session_id)
+                self._bytes_disco += len(datos)
+            sobrantes += self._ajustar_disco()
+        for ruta in sobrantes:
+            self._borrar_archivo(ruta)
+
+    def _recuperar_de_disco(self, clave, entrada_disco):
+        ruta, tamano, comprimido, session_id = entrada_disco
+        try:
+            with open(ruta, 'rb') as f:
+                datos = f.read()
+        except OSError as e:
+            logger.warning(f"BlobStore: no se pudo leer '{clave}' desde disco, se descarta: {e}")
+            datos = None
+        desalojados = []
+        with self._lock:
+            if self._disco.get(clave) is not entrada_disco:
+                # Cambió mientras se leía: se usa lo que haya ahora en memoria, si algo.
+                entrada = self._memoria.get(clave) or self._en_escritura.get(clave)
+            else:
+                del self._disco[clave]
+                self._bytes_disco -= tamano
+                if datos is None:
+                    self._descartes_disco += 1
+                    entrada = None
+                else:
+                    entrada = (datos, comprimido, session_id)
+                    self._memoria[clave] = entrada
+                    self._bytes_memoria += len(datos)
+                    desalojados = self._ajustar_memoria()
+        self._desbordar(desalojados, [ruta])
+        return entrada
+
+    @staticmethod
+    def _borrar_archivo(ruta):
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
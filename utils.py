@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 from fpdf import FPDF
+import json
 from datetime import datetime
+from functools import lru_cache
+import numpy as np
 import plotly.graph_objects as go
 
 # --- CLASE PARA GENERACIÓN DE PDF ---
@@ -88,12 +91,58 @@ def obtener_interpretacion_riesgo(score):
     elif 15 <= score <= 20: return "Riesgo alto", "1 de cada 3 personas desarrollará diabetes."
     else: return "Riesgo muy alto", "1 de cada 2 personas desarrollará diabetes."
 
-# --- FUNCIÓN DE GRÁFICO ---
-def generar_grafico_riesgo(score):
+# --- FUNCIONES DE GRÁFICO ---
+# Franjas de riesgo FINDRISC compartidas por el indicador y la gráfica de tendencia.
+RANGOS_RIESGO = [((0, 6), '#28a745'), ((7, 11), '#a3d900'), ((12, 14), '#ffc107'), ((15, 20), '#fd7e14'), ((21, 25), '#dc3545')]
+
+@lru_cache(maxsize=1)
+def _plantilla_grafico_riesgo():
+    """Construye una única vez el indicador base; solo cambian el valor y el umbral."""
     fig = go.Figure(go.Indicator(
-        mode="gauge+number", value=score, domain={'x': [0, 1], 'y': [0, 1]}, title={'text': "<b>Nivel de Riesgo de Diabetes</b>"},
+        mode="gauge+number", value=0, domain={'x': [0, 1], 'y': [0, 1]}, title={'text': "<b>Nivel de Riesgo de Diabetes</b>"},
         gauge={'axis': {'range': [0, 25], 'tickwidth': 1, 'tickcolor': "darkblue"}, 'bar': {'color': "rgba(0,0,0,0.4)"}, 'bgcolor': "white", 'borderwidth': 2, 'bordercolor': "#cccccc",
-               'steps': [{'range': [0, 6], 'color': '#28a745'}, {'range': [7, 11], 'color': '#a3d900'}, {'range': [12, 14], 'color': '#ffc107'}, {'range': [15, 20], 'color': '#fd7e14'}, {'range': [21, 25], 'color': '#dc3545'}],
-               'threshold': {'line': {'color': "black", 'width': 4}, 'thickness': 0.85, 'value': score}}))
+               'steps': [{'range': list(rango), 'color': color} for rango, color in RANGOS_RIESGO],
+               'threshold': {'line': {'color': "black", 'width': 4}, 'thickness': 0.85, 'value': 0}}))
     fig.update_layout(paper_bgcolor="rgba(0,0,0,0)", font={'color': "#333333", 'family': "Arial"})
     return fig
+
+@lru_cache(maxsize=32)
+def _grafico_riesgo_json(score):
+    """JSON del indicador para un puntaje; el puntaje solo toma unos pocos valores enteros."""
+    fig = go.Figure(_plantilla_grafico_riesgo())
+    fig.update_traces(value=score, gauge_threshold_value=score)
+    return fig.to_json()
+
+def generar_grafico_riesgo(score):
+    """Devuelve una figura nueva del indicador a partir del JSON cacheado, sin volver a validarla,
+    de modo que cada llamada puede modificar su copia sin afectar a otras sesiones."""
+    return go.Figure(json.loads(_grafico_riesgo_json(score)), _validate=False)
+
+def _fecha_sin_zona(fecha):
+    """Convierte la fecha (texto ISO o datetime) a un datetime sin zona horaria, como la muestra el historial."""
+    if not isinstance(fecha, datetime):
+        fecha = datetime.fromisoformat(fecha)
+    return fecha.replace(tzinfo=None)
+
+def generar_grafico_historial(historial):
+    """Gráfica de tendencia del puntaje a partir del historial, en una sola traza.
+
+    Las fechas y puntajes se convierten a arreglos de numpy de una vez, de modo que
+    el costo no depende de crear un componente por cada test."""
+    registros = [t for t in historial if 'fecha' in t and t.get('puntaje') is not None]
+    fechas = np.array([_fecha_sin_zona(t['fecha']) for t in registros], dtype='datetime64[us]')
+    puntajes = np.fromiter((t['puntaje'] for t in registros), dtype=np.int16, count=len(registros))
+    orden = np.argsort(fechas, kind='stable')
+    fechas, puntajes = fechas[orden], puntajes[orden]
+
+    fig = go.Figure(go.Scattergl(
+        x=fechas, y=puntajes, mode="lines+markers" if len(puntajes) <= 200 else "lines",
+        line={'color': "#4F46E5", 'width': 2}, marker={'size': 6},
+        hovertemplate="%{x|%d-%m-%Y %H:%M}<br>Puntaje: %{y}<extra></extra>"))
+    fig.update_layout(
+        title={'text': "<b>Evolución del Puntaje FINDRISC</b>"}, paper_bgcolor="rgba(0,0,0,0)", plot_bgcolor="rgba(0,0,0,0)",
+        font={'color': "#333333", 'family': "Arial"}, yaxis={'range': [0, 26], 'title': "Puntaje"}, xaxis={'title': "Fecha"},
+        shapes=[{'type': "rect", 'xref': "paper", 'x0': 0, 'x1': 1, 'y0': rango[0], 'y1': rango[1] + 1, 'fillcolor': color,
+                 'opacity': 0.12, 'line': {'width': 0}, 'layer': "below"} for rango, color in RANGOS_RIESGO],
+        margin={'l': 40, 'r': 20, 't': 60, 'b': 40})
+    return fig